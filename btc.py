@@ -7,21 +7,20 @@ import sys
 import os
 import re
 import argparse
-import copy
 import subprocess
-import configparser
 import socket
-import glob
-import shutil
-import json
-import difflib
+import select
+import errno
+import signal
+import time
+import itertools
+from collections import deque
 from datetime import datetime, timezone
 
 
 VERSION="2.4.0"
 
 PROJECT_NAME = "bitcoinprotocols"
-CURDIR = os.getcwd()
 SCRIPTDIR = os.path.dirname(os.path.realpath(__file__))
 BTC_CONFIG_FILE = ".btc.config"
 BTC_CONFIG_PATH = os.path.join(SCRIPTDIR, BTC_CONFIG_FILE)
@@ -48,6 +47,7 @@ REPARSE_CHOICES = ['counterparty', 'counterparty-testnet']
 ROLLBACK_CHOICES = ['counterparty', 'counterparty-testnet']
 VALIDATE_CHOICES = ['counterparty', 'counterparty-testnet']
 VACUUM_CHOICES = ['counterparty', 'counterparty-testnet']
+UPDATE_CHOICES_SET = frozenset(UPDATE_CHOICES)  # for membership checks
 SHELL_CHOICES = UPDATE_CHOICES + ['mongodb', 'redis', 'bitcoin', 'bitcoin-testnet', 'addrindexrs', 'addrindexrs-testnet']
 
 CONFIGCHECK_FILES_BASE_EXTERNAL_BITCOIN = [
@@ -74,6 +74,18 @@ CONFIGCHECK_FILES = {
     'base': CONFIGCHECK_FILES_BASE,
     'full': CONFIGCHECK_FILES_BASE,
 }
+DOCKER_CLEAN_BATCH_SIZE = 500
+# connect_ex() results of a non-blocking connect that is still in progress
+CONNECT_IN_PROGRESS_ERRNOS = frozenset(getattr(errno, name) for name in ('EINPROGRESS', 'EWOULDBLOCK', 'EAGAIN', 'WSAEWOULDBLOCK') if hasattr(errno, name))
+
+_SECTION_RE = re.compile(r'^\[(.+)\]\s*$')
+_KV_RE = re.compile(r'^([^=:\s]+)\s*[=:]\s*(.*)$')
+# non-blank, non-comment config lines, without line endings (so CRLF files compare equal to LF ones).
+# anchored, so it scans the buffer in a single linear pass
+_NONCOMMENT_RE = re.compile(rb'(?m)^[ \t]*[^#\s][^\r\n]*')
+# an 'exec' command given as a single, already quoted, argument
+_QUOTED_ARG_RE = re.compile(r'^[\'"].*?[\'"]$')
+
 # set in setup_env()
 IS_WINDOWS = None
 SESSION_USER = None
@@ -82,15 +94,45 @@ SUDO_CMD = None
 DOCKER_CONFIG_PATH = None
 
 
-def parse_args():
-    parser = argparse.ArgumentParser(prog='btc', description='btc utility v{}'.format(VERSION))
-    parser.add_argument("-V", '--version', action='version', version='%(prog)s {}'.format(VERSION))
-    parser.add_argument("-d", "--debug", action='store_true', default=False, help="increase output verbosity")
-    parser.add_argument("--no-pull", action='store_true', default=False, help="use only local docker images (for debugging)")
+class FastConfigParser(object):
+    """Minimal INI reader/writer for the flat .btc.config file (sections of key = value pairs)"""
+    def __init__(self):
+        self._sections = {}
 
-    subparsers = parser.add_subparsers(help='help on modes', dest='command')
-    subparsers.required = True
+    def read(self, path):
+        with open(path) as f:
+            lines = f.read().splitlines()
+        section = None
+        for line in lines:
+            line = line.strip()
+            if not line or line[0] in '#;':
+                continue
+            m = _SECTION_RE.match(line)
+            if m:
+                section = self._sections.setdefault(m.group(1), {})
+                continue
+            m = _KV_RE.match(line)
+            if m and section is not None:
+                section[m.group(1).lower()] = m.group(2).strip()
+
+    def add_section(self, section):
+        self._sections.setdefault(section, {})
+
+    def get(self, section, key):
+        return self._sections[section][key.lower()]
+
+    def set(self, section, key, value):
+        self._sections[section][key.lower()] = value
+
+    def write(self, fp):
+        for section, items in self._sections.items():
+            fp.write("[{}]\n".format(section))
+            for key, value in items.items():
+                fp.write("{} = {}\n".format(key, value))
+            fp.write("\n")
 
+
+def _build_install_parser(subparsers):
     parser_install = subparsers.add_parser('install', help="install btc services")
     parser_install.add_argument("config", choices=['base', 'base_extbtc', 'full'], help="The name of the service configuration to utilize")
     parser_install.add_argument("branch", choices=['master', 'develop'], help="The name of the git branch to utilize for the build (note that 'master' pulls the docker 'latest' tags)")
@@ -98,77 +140,183 @@ def parse_args():
     parser_install.add_argument("--mongodb-interface", default="127.0.0.1",
         help="Bind mongo to this host interface. Localhost by default, enter 0.0.0.0 for all host interfaces.")
     parser_install.add_argument("--no-bootstrap", action="store_true", help="It doesn't download any bootstrap, so the parse will begin from scratch")
-    
 
+def _build_uninstall_parser(subparsers):
     parser_uninstall = subparsers.add_parser('uninstall', help="uninstall btc services")
 
+def _build_start_parser(subparsers):
     parser_start = subparsers.add_parser('start', help="start btc services")
     parser_start.add_argument("services", nargs='*', default='', help="The service or services to start (or blank for all services)")
 
+def _build_stop_parser(subparsers):
     parser_stop = subparsers.add_parser('stop', help="stop btc services")
     parser_stop.add_argument("services", nargs='*', default='', help="The service or services to stop (or blank for all services)")
 
+def _build_restart_parser(subparsers):
     parser_restart = subparsers.add_parser('restart', help="restart btc services")
     parser_restart.add_argument("services", nargs='*', default='', help="The service or services to restart (or blank for all services)")
 
+def _build_reparse_parser(subparsers):
     parser_reparse = subparsers.add_parser('reparse', help="reparse a counterparty-server service")
     parser_reparse.add_argument("service", choices=REPARSE_CHOICES, help="The name of the service for which to kick off a reparse")
 
+def _build_rollback_parser(subparsers):
     parser_rollback = subparsers.add_parser('rollback', help="rollback a counterparty-server")
     parser_rollback.add_argument("block_index", help="the index of the last known good block")
     parser_rollback.add_argument("service", choices=ROLLBACK_CHOICES, help="The name of the service to rollback")
 
+def _build_validate_parser(subparsers):
     parser_validate = subparsers.add_parser('validate', help="makes a database integrity check in counterparty-server")
     parser_validate.add_argument("service", choices=VALIDATE_CHOICES, help="The name of the service to make the integrity check")
 
+def _build_vacuum_parser(subparsers):
     parser_vacuum = subparsers.add_parser('vacuum', help="vacuum the counterparty-server database for better runtime performance")
     parser_vacuum.add_argument("service", choices=VACUUM_CHOICES, help="The name of the service whose database to vacuum")
 
+def _build_ps_parser(subparsers):
     parser_ps = subparsers.add_parser('ps', help="list installed services")
 
+def _build_tail_parser(subparsers):
     parser_tail = subparsers.add_parser('tail', help="tail btc logs")
     parser_tail.add_argument("services", nargs='*', default='', help="The name of the service or services whose logs to tail (or blank for all services)")
     parser_tail.add_argument("-n", "--num-lines", type=int, default=50, help="Number of lines to tail")
 
+def _build_logs_parser(subparsers):
     parser_logs = subparsers.add_parser('logs', help="tail btc logs")
     parser_logs.add_argument("services", nargs='*', default='', help="The name of the service or services whose logs to view (or blank for all services)")
 
+def _build_exec_parser(subparsers):
     parser_exec = subparsers.add_parser('exec', help="execute a command on a specific container")
     parser_exec.add_argument("service", choices=SHELL_CHOICES, help="The name of the service to execute the command on")
     parser_exec.add_argument("cmd", nargs=argparse.REMAINDER, help="The shell command to execute")
 
+def _build_shell_parser(subparsers):
     parser_shell = subparsers.add_parser('shell', help="get a shell on a specific service container")
     parser_shell.add_argument("service", choices=SHELL_CHOICES, help="The name of the service to shell into")
 
+def _build_update_parser(subparsers):
     parser_update = subparsers.add_parser('update', help="upgrade btc services (i.e. update source code and restart the container, but don't update the container itself')")
     parser_update.add_argument("-n", "--no-restart", action="store_true", help="Don't restart the container after updating the code'")
     parser_update.add_argument("services", nargs='*', default='', help="The name of the service or services to update (or blank to for all applicable services)")
 
+def _build_rebuild_parser(subparsers):
     parser_rebuild = subparsers.add_parser('rebuild', help="rebuild btc services (i.e. remove and refetch/install docker containers)")
     parser_rebuild.add_argument("services", nargs='*', default='', help="The name of the service or services to rebuild (or blank for all services)")
     parser_rebuild.add_argument("--mongodb-interface", default="127.0.0.1")
     parser_rebuild.add_argument("--no-cache", action="store_true", help="Rebuilds service or services images from scratch before installing containers")
 
+def _build_docker_clean_parser(subparsers):
     parser_docker_clean = subparsers.add_parser('docker_clean', help="remove ALL docker containers and cached images (use with caution!)")
 
+def _build_configcheck_parser(subparsers):
     parser_configcheck = subparsers.add_parser('configcheck', help="check configuration")
 
-    return parser.parse_args()
+# ordered as they should appear in the --help output
+COMMAND_PARSER_BUILDERS = {
+    'install': _build_install_parser,
+    'uninstall': _build_uninstall_parser,
+    'start': _build_start_parser,
+    'stop': _build_stop_parser,
+    'restart': _build_restart_parser,
+    'reparse': _build_reparse_parser,
+    'rollback': _build_rollback_parser,
+    'validate': _build_validate_parser,
+    'vacuum': _build_vacuum_parser,
+    'ps': _build_ps_parser,
+    'tail': _build_tail_parser,
+    'logs': _build_logs_parser,
+    'exec': _build_exec_parser,
+    'shell': _build_shell_parser,
+    'update': _build_update_parser,
+    'rebuild': _build_rebuild_parser,
+    'docker_clean': _build_docker_clean_parser,
+    'configcheck': _build_configcheck_parser,
+}
+
+# leading options that still allow building only the requested command's subparser
+LAZY_PARSE_GLOBAL_OPTS = frozenset(['-d', '--debug', '--no-pull'])
+
+def parse_args(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+
+    parser = argparse.ArgumentParser(prog='btc', description='btc utility v{}'.format(VERSION))
+    parser.add_argument("-V", '--version', action='version', version='%(prog)s {}'.format(VERSION))
+    parser.add_argument("-d", "--debug", action='store_true', default=False, help="increase output verbosity")
+    parser.add_argument("--no-pull", action='store_true', default=False, help="use only local docker images (for debugging)")
+
+    subparsers = parser.add_subparsers(help='help on modes', dest='command')
+    subparsers.required = True
+
+    # only build the subparser for the requested command; fall back to building all of them
+    # for top-level help/version output and error reporting. (the global options take no values,
+    # so the first non-option argument is always the command.) any other leading option, including
+    # combined short flags (-dh) and abbreviated long ones (--hel), takes the fallback path
+    command, global_opts = None, []
+    for arg in argv:
+        if not arg.startswith('-'):
+            command = arg
+            break
+        global_opts.append(arg)
+    if command in COMMAND_PARSER_BUILDERS and set(global_opts) <= LAZY_PARSE_GLOBAL_OPTS:
+        COMMAND_PARSER_BUILDERS[command](subparsers)
+    else:
+        for build_parser in COMMAND_PARSER_BUILDERS.values():
+            build_parser(subparsers)
+
+    return parser.parse_args(argv)
 
 def write_config(config):
     cfg_file = open(BTC_CONFIG_PATH, 'w')
     config.write(cfg_file)
     cfg_file.close()
 
+def call_foreground(args):
+    # like os.system(), ignore SIGINT while the child runs, so that Ctrl-C (e.g. to leave 'logs -f')
+    # is handled by the child alone instead of raising KeyboardInterrupt here
+    proc = subprocess.Popen(args)
+    prev_handler = signal.signal(signal.SIGINT, signal.SIG_IGN)
+    try:
+        return proc.wait()
+    finally:
+        signal.signal(signal.SIGINT, prev_handler)
+
 def run_compose_cmd(cmd):
     assert DOCKER_CONFIG_PATH
     assert os.environ['BTC_RELEASE_TAG']
-    return os.system("{} docker-compose -f {} -p {} {}".format(SUDO_CMD, DOCKER_CONFIG_PATH, PROJECT_NAME, cmd))
-
-def is_port_open(port):
-    # TCP ports only
-    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    return sock.connect_ex(('127.0.0.1', port)) == 0  # returns True if the port is open
+    return call_foreground(SUDO_CMD.split() + ['docker-compose', '-f', DOCKER_CONFIG_PATH, '-p', PROJECT_NAME] + list(cmd))
+
+def get_open_ports(ports, timeout=0.5):
+    # TCP ports only. Probes all ports at once with non-blocking connects, so that at most
+    # a single timeout is waited for. Returns the (ordered) list of ports that are open
+    socks = {}
+    open_ports = set()
+    pending = set()
+    try:
+        for port in ports:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.setblocking(False)
+            socks[sock] = port
+            result = sock.connect_ex(('127.0.0.1', port))
+            if result == 0:
+                open_ports.add(port)
+            elif result in CONNECT_IN_PROGRESS_ERRNOS:
+                pending.add(sock)
+            # (any other error, e.g. an immediate ECONNREFUSED, means the port is closed)
+        deadline = time.monotonic() + timeout
+        while pending:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            _, writable, errored = select.select([], list(pending), list(pending), remaining)
+            for sock in set(writable) | set(errored):
+                if sock not in errored and sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) == 0:
+                    open_ports.add(socks[sock])
+                pending.discard(sock)
+    finally:
+        for sock in socks:
+            sock.close()
+    return [port for port in ports if port in open_ports]
 
 def setup_env():
     global IS_WINDOWS
@@ -176,10 +324,11 @@ def setup_env():
     global SUDO_CMD
     if os.name != 'nt':
         IS_WINDOWS = False
-        SESSION_USER = subprocess.check_output("logname", shell=True).decode("utf-8").strip()
+        import pwd  # POSIX only
+        SESSION_USER = os.environ.get('SUDO_USER') or pwd.getpwuid(os.getuid()).pw_name
         assert SESSION_USER
         SUDO_CMD = "sudo -E"
-        IS_SUDO_ACTIVE = subprocess.check_output('sudo -n uptime 2>&1|grep "load"|wc -l', shell=True).decode("utf-8").strip() == "1"
+        IS_SUDO_ACTIVE = subprocess.call(['sudo', '-vn'], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL) == 0
     else:
         IS_WINDOWS = True
         SESSION_USER = None
@@ -192,11 +341,15 @@ def setup_env():
 
     if not IS_SUDO_ACTIVE:
         print("This script requires root access (via sudo) to run. Please enter your sudo password below.")
-        os.system("bash -c 'sudo whoami > /dev/null'")
+        subprocess.call(['sudo', 'whoami'], stdout=subprocess.DEVNULL)
+
+def docker_cmd_args(*args):
+    # argv for a docker CLI call, so that it can be run without an intermediate shell
+    return SUDO_CMD.split() + ['docker'] + list(args)
 
 def is_container_running(service, abort_on_not_exist=True):
     try:
-        container_running = subprocess.check_output('{} docker inspect --format="{{{{ .State.Running }}}}" bitcoinprotocols_{}_1'.format(SUDO_CMD, service), shell=True).decode("utf-8").strip()
+        container_running = subprocess.check_output(docker_cmd_args('inspect', '--format={{ .State.Running }}', 'bitcoinprotocols_{}_1'.format(service))).decode("utf-8").strip()
         container_running = container_running == 'true'
     except subprocess.CalledProcessError:
         container_running = None
@@ -205,50 +358,112 @@ def is_container_running(service, abort_on_not_exist=True):
             sys.exit(1)
     return container_running
 
-def get_docker_volume_path(volume_name):
+def iter_batches(items, batch_size):
+    it = iter(items)
+    while True:
+        batch = list(itertools.islice(it, batch_size))
+        if not batch:
+            return
+        yield batch
+
+def get_docker_volume_paths(volume_names):
+    # inspect all volumes with a single docker call; returns {volume_name: mountpoint} for those that exist
+    import json
+    if not volume_names:
+        return {}
     try:
-        json_output = subprocess.check_output('{} docker volume inspect {}'.format(SUDO_CMD, volume_name), shell=True).decode("utf-8").strip()
-    except subprocess.CalledProcessError:
+        json_output = subprocess.check_output(docker_cmd_args('volume', 'inspect', *volume_names))
+    except subprocess.CalledProcessError as e:
+        # docker still outputs the volumes that do exist when some of them are missing
+        json_output = e.output
+    try:
+        volume_info = json.loads(json_output)
+    except ValueError:  # (also covers empty output)
+        return {}
+    return {v['Name']: v['Mountpoint'] for v in volume_info}
+
+def git_current_branch(repo_path):
+    # the checked out branch name, read straight from .git/HEAD (None if detached or unreadable)
+    try:
+        with open(os.path.join(repo_path, '.git', 'HEAD')) as f:
+            head = f.read().strip()
+    except OSError:
         return None
-    volume_info = json.loads(json_output)
-    return volume_info[0]['Mountpoint']
+    return head.split('refs/heads/', 1)[1] if head.startswith('ref:') else None
+
+def iter_default_configs():
+    # yields the DirEntry of each config/<service>/<file>.default
+    with os.scandir(os.path.join(SCRIPTDIR, 'config')) as service_entries:
+        for service_entry in service_entries:
+            if not service_entry.is_dir():
+                continue
+            with os.scandir(service_entry.path) as config_entries:
+                for config_entry in config_entries:
+                    if config_entry.name.endswith('.default') and config_entry.is_file():
+                        yield config_entry
 
 def file_mtime(path):
     t = datetime.fromtimestamp(os.stat(path).st_mtime, timezone.utc)
     return t.astimezone().isoformat()
 
+def config_signature(path):
+    # digest of the file's non-blank, non-comment lines, used to skip diffing files that match
+    import hashlib
+    import mmap
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return digest.digest()
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            digest.update(b'\n'.join(_NONCOMMENT_RE.findall(mm)))
+    return digest.digest()
+
+def _check_one(config_spec):
+    # returns the lines to print for a single (dirname, fromfile, tofile) config pair
+    import difflib
+    dirname, fromfile, tofile = config_spec
+
+    try:
+        fromfilepath = os.path.join(SCRIPTDIR, 'config', dirname, fromfile)
+        fromdate = file_mtime(fromfilepath)
+    except FileNotFoundError as e:
+        return ["Config file not found at {}".format(fromfilepath)]
+
+    try:
+        tofilepath = os.path.join(SCRIPTDIR, 'config', dirname, tofile)
+        todate = file_mtime(tofilepath)
+    except FileNotFoundError as e:
+        return ["Config file not found at {}".format(tofilepath)]
+
+    if config_signature(fromfilepath) == config_signature(tofilepath):
+        return ["{}: OK".format(os.path.join(dirname, tofile))]
+
+    with open(fromfilepath, 'rb') as ff:
+        fromlines = _NONCOMMENT_RE.findall(ff.read())
+    with open(tofilepath, 'rb') as tf:
+        tolines = _NONCOMMENT_RE.findall(tf.read())
+
+    diff = difflib.diff_bytes(difflib.unified_diff, fromlines, tolines, fromfile.encode(), tofile.encode(),
+        fromdate.encode(), todate.encode(), n=3, lineterm=b'')
+    diff_string = b"".join(line + b"\n" for line in diff).decode("utf-8", "replace")
+    if len(diff_string):
+        return ["Found these differences in the file {}:\n".format(tofilepath), "{}".format(diff_string)]
+    else:
+        return ["{}: OK".format(os.path.join(dirname, tofile))]
+
 def config_check(build_config):
-    for dirname, fromfile, tofile in CONFIGCHECK_FILES[build_config]:
-        # dirname, fromfile, tofile = config_spec
-
-        try:
-            fromfilepath = os.path.join(SCRIPTDIR, 'config', dirname, fromfile)
-            fromdate = file_mtime(fromfilepath)
-        except FileNotFoundError as e:
-            print("Config file not found at {}".format(fromfilepath))
-            continue
-
-        try:
-            tofilepath = os.path.join(SCRIPTDIR, 'config', dirname, tofile)
-            todate = file_mtime(tofilepath)
-        except FileNotFoundError as e:
-            print("Config file not found at {}".format(tofilepath))
-            continue
-
-
-        linejunk_filter = lambda x: len(x.strip()) > 0 and x.strip()[0:1] != '#'
-        with open(fromfilepath) as ff:
-            fromlines = list(filter(linejunk_filter, ff.readlines()))
-        with open(tofilepath) as tf:
-            tolines = list(filter(linejunk_filter, tf.readlines()))
-
-        diff = difflib.unified_diff(fromlines, tolines, fromfile, tofile, fromdate, todate, n=3)
-        diff_string = "".join(diff)
-        if len(diff_string):
-            print("Found these differences in the file {}:\n".format(tofilepath))
-            print("{}".format(diff_string))
-        else:
-            print("{}: OK".format(os.path.join(dirname, tofile)))
+    import concurrent.futures
+    # the file pairs are independent, so check them concurrently (mostly overlapping the file reads)
+    config_specs = CONFIGCHECK_FILES[build_config]
+    results = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(config_specs)) as executor:
+        futures = {executor.submit(_check_one, config_spec): i for i, config_spec in enumerate(config_specs)}
+        for future in concurrent.futures.as_completed(futures):
+            results[futures[future]] = future.result()
+
+    # output in the original order, with a single write
+    lines = [line for i in range(len(config_specs)) for line in results[i]]
+    sys.stdout.write("\n".join(lines) + "\n")
 
     return
 
@@ -261,22 +476,19 @@ def main():
 
     # run utility commands (docker_clean) if specified
     if args.command == 'docker_clean':
-        docker_containers = subprocess.check_output("{} docker ps -a -q".format(SUDO_CMD), shell=True).decode("utf-8").split('\n')
-        docker_images = subprocess.check_output("{} docker images -q".format(SUDO_CMD), shell=True).decode("utf-8").split('\n')
-        for container in docker_containers:
-            if not container:
-                continue
-            os.system("{} docker rm {}".format(SUDO_CMD, container))
-        for image in docker_images:
-            if not image:
-                continue
-            os.system("{} docker rmi {}".format(SUDO_CMD, image))
+        docker_containers = [c for c in subprocess.check_output(docker_cmd_args('ps', '-a', '-q')).decode("utf-8").split('\n') if c]
+        docker_images = [i for i in subprocess.check_output(docker_cmd_args('images', '-q')).decode("utf-8").split('\n') if i]
+        # remove in batches, to keep the number of docker calls down (while staying well under ARG_MAX)
+        for batch in iter_batches(docker_containers, DOCKER_CLEAN_BATCH_SIZE):
+            subprocess.call(docker_cmd_args('rm', *batch))
+        for batch in iter_batches(docker_images, DOCKER_CLEAN_BATCH_SIZE):
+            subprocess.call(docker_cmd_args('rmi', *batch))
         sys.exit(1)
 
     # for all other commands
     # if config doesn't exist, only the 'install' command may be run
     config_existed = os.path.exists(BTC_CONFIG_PATH)
-    config = configparser.ConfigParser()
+    config = FastConfigParser()
     if not config_existed:
         if args.command != 'install':
             print("config file {} does not exist. Please run the 'install' command first".format(BTC_CONFIG_FILE))
@@ -307,10 +519,10 @@ def main():
             sys.exit(1)
 
         # check port usage
-        for port in HOST_PORTS_USED[build_config]:
-            if is_port_open(port):
-                print("Cannot install, as it appears a process is already listening on host port {}".format(port))
-                sys.exit(1)
+        open_ports = get_open_ports(HOST_PORTS_USED[build_config])
+        if open_ports:
+            print("Cannot install, as it appears a process is already listening on host port {}".format(open_ports[0]))
+            sys.exit(1)
 
         # check out the necessary source trees (don't use submodules due to detached HEAD and other problems)
         REPOS = REPOS_BASE if build_config == 'base' else REPOS_FULL
@@ -326,18 +538,20 @@ def main():
 
         # make sure we have the newest image for each service
         if use_docker_pulls:
-            run_compose_cmd("pull --ignore-pull-failures")
+            run_compose_cmd(['pull', '--ignore-pull-failures'])
         else:
             print("skipping docker pull command")
 
 
         # copy over the configs from .default to active versions, if they don't already exist
-        for default_config in glob.iglob(os.path.join(SCRIPTDIR, 'config', '**/*.default'), recursive=True):
+        import shutil
+        for default_config_entry in iter_default_configs():
+            default_config = default_config_entry.path
             active_config = default_config.replace('.default', '')
             if not os.path.exists(active_config):
                 print("Generating config from defaults at {} ...".format(active_config))
                 shutil.copy2(default_config, active_config)
-                default_config_stat = os.stat(default_config)
+                default_config_stat = default_config_entry.stat()
                 if not IS_WINDOWS:
                     os.chown(active_config, default_config_stat.st_uid, default_config_stat.st_gid)
 
@@ -347,48 +561,50 @@ def main():
             if not os.path.exists(data_dir):
                 os.mkdir(data_dir)
 
+            volume_paths = get_docker_volume_paths(["{}_{}".format(PROJECT_NAME, volume) for volume in VOLUMES_USED[build_config]])
             for volume in VOLUMES_USED[build_config]:
                 symlink_path = os.path.join(data_dir, volume.replace('-data', ''))
                 volume_name = "{}_{}".format(PROJECT_NAME, volume)
-                mountpoint_path = get_docker_volume_path(volume_name)
+                mountpoint_path = volume_paths.get(volume_name)
                 if mountpoint_path is not None and not os.path.lexists(symlink_path):
                     os.symlink(mountpoint_path, symlink_path)
                     print("For convenience, symlinking {} to {}".format(mountpoint_path, symlink_path))
 
         # launch
-        run_compose_cmd("up -d")
+        run_compose_cmd(['up', '-d'])
     elif args.command == 'uninstall':
-        run_compose_cmd("down")
+        run_compose_cmd(['down'])
         os.remove(BTC_CONFIG_PATH)
     elif args.command == 'start':
-        run_compose_cmd("start {}".format(' '.join(args.services)))
+        run_compose_cmd(['start'] + list(args.services))
     elif args.command == 'stop':
-        run_compose_cmd("stop {}".format(' '.join(args.services)))
+        run_compose_cmd(['stop'] + list(args.services))
     elif args.command == 'restart':
-        run_compose_cmd("restart {}".format(' '.join(args.services)))
+        run_compose_cmd(['restart'] + list(args.services))
     elif args.command == 'reparse':
-        run_compose_cmd("stop {}".format(args.service))
-        run_compose_cmd("run -e COMMAND=reparse {}".format(args.service))
+        run_compose_cmd(['stop', args.service])
+        run_compose_cmd(['run', '-e', 'COMMAND=reparse', args.service])
     elif args.command == 'rollback':
-        run_compose_cmd("stop {}".format(args.service))
-        run_compose_cmd("run -e COMMAND='rollback {}' {}".format(args.block_index, args.service))
+        run_compose_cmd(['stop', args.service])
+        run_compose_cmd(['run', '-e', 'COMMAND=rollback {}'.format(args.block_index), args.service])
     elif args.command == 'validate':
-        run_compose_cmd("stop {}".format(args.service))
-        run_compose_cmd("run -e COMMAND=checkdb {}".format(args.service))
+        run_compose_cmd(['stop', args.service])
+        run_compose_cmd(['run', '-e', 'COMMAND=checkdb', args.service])
     elif args.command == 'vacuum':
-        run_compose_cmd("stop {}".format(args.service))
-        run_compose_cmd("run -e COMMAND=vacuum {}".format(args.service))
+        run_compose_cmd(['stop', args.service])
+        run_compose_cmd(['run', '-e', 'COMMAND=vacuum', args.service])
     elif args.command == 'tail':
-        run_compose_cmd("logs -f --tail={} {}".format(args.num_lines, ' '.join(args.services)))
+        run_compose_cmd(['logs', '-f', '--tail={}'.format(args.num_lines)] + list(args.services))
     elif args.command == 'logs':
-        run_compose_cmd("logs {}".format(' '.join(args.services)))
+        run_compose_cmd(['logs'] + list(args.services))
     elif args.command == 'ps':
-        run_compose_cmd("ps")
+        run_compose_cmd(['ps'])
     elif args.command == 'exec':
-        if len(args.cmd) == 1 and re.match("['\"].*?['\"]", args.cmd[0]):
-            cmd = args.cmd
+        if len(args.cmd) == 1 and _QUOTED_ARG_RE.match(args.cmd[0]):
+            cmd = args.cmd[0]  # already quoted by the user
         else:
-            cmd = '"{}"'.format(' '.join(args.cmd).replace('"', '\\"'))
+            import shlex
+            cmd = shlex.quote(' '.join(args.cmd))
         os.system("{} docker exec -i -t bitcoinprotocols_{}_1 bash -c {}".format(SUDO_CMD, args.service, cmd))
     elif args.command == 'shell':
         container_running = is_container_running(args.service)
@@ -396,20 +612,20 @@ def main():
             os.system("{} docker exec -i -t bitcoinprotocols_{}_1 bash".format(SUDO_CMD, args.service))
         else:
             print("Container is not running -- creating a transient container with a 'bash' shell entrypoint...")
-            run_compose_cmd("run --no-deps --rm --entrypoint bash {}".format(args.service))
+            run_compose_cmd(['run', '--no-deps', '--rm', '--entrypoint', 'bash', args.service])
     elif args.command == 'update':
         # validate
         if args.services != ['', ]:
             for service in args.services:
-                if service not in UPDATE_CHOICES:
+                if service not in UPDATE_CHOICES_SET:
                     print("Invalid service: {}".format(service))
                     sys.exit(1)
 
-        services_to_update = copy.copy(UPDATE_CHOICES) if not len(args.services) else args.services
+        services_to_update = deque(UPDATE_CHOICES if not len(args.services) else args.services)
         git_has_updated = []
         while services_to_update:
             # update source code
-            service = services_to_update.pop(0)
+            service = services_to_update.popleft()
             service_base = service.replace('-testnet', '')
             if service_base not in git_has_updated:
                 git_has_updated.append(service_base)
@@ -421,18 +637,20 @@ def main():
                     service_dir_path = os.path.join(SCRIPTDIR, "src", service_dir)
                     if not os.path.exists(service_dir_path):
                         continue
-                    service_branch = subprocess.check_output("cd {};git symbolic-ref --short -q HEAD;cd {}".format(service_dir_path, CURDIR), shell=True).decode("utf-8").strip()
+                    service_branch = git_current_branch(service_dir_path)
                     if not service_branch:
                         print("Unknown service git branch name, or repo in detached state")
                         sys.exit(1)
-                    git_cmd = "cd {}; git pull origin {}; cd {}".format(service_dir_path, service_branch, CURDIR)
+                    git_cmd = ['git', '-C', service_dir_path, 'pull', 'origin', service_branch]
                     if not IS_WINDOWS:  # make sure to update the code as the original user, so the permissions are right
-                        os.system("{} -u {} bash -c \"{}\"".format(SUDO_CMD, SESSION_USER, git_cmd))
+                        call_foreground(SUDO_CMD.split() + ['-u', SESSION_USER] + git_cmd)
                     else:
-                        os.system(git_cmd)
+                        call_foreground(git_cmd)
 
                     # delete installed egg (to force egg recreate and deps re-check on next start)
                     if service_base in ('counterparty', 'armory-utxsvr'):
+                        import glob
+                        import shutil
                         for path in glob.glob(os.path.join(service_dir_path, "*.egg-info")):
                             print("Removing egg path {}".format(path))
                             if not IS_WINDOWS:  # have to use root
@@ -442,19 +660,19 @@ def main():
 
             # and restart container
             if not args.no_restart:
-                run_compose_cmd("restart {}".format(service))
+                run_compose_cmd(['restart', service])
     elif args.command == 'configcheck':
         config_check(build_config)
     elif args.command == 'rebuild':
         if use_docker_pulls:
-            run_compose_cmd("pull --ignore-pull-failures {}".format(' '.join(args.services)))
+            run_compose_cmd(['pull', '--ignore-pull-failures'] + list(args.services))
         else:
             print("skipping docker pull command")
         
         if args.no_cache:
-            run_compose_cmd("build --no-cache {}".format(' '.join(args.services)))
+            run_compose_cmd(['build', '--no-cache'] + list(args.services))
             
-        run_compose_cmd("up -d --build --force-recreate --no-deps {}".format(' '.join(args.services)))
+        run_compose_cmd(['up', '-d', '--build', '--force-recreate', '--no-deps'] + list(args.services))
 
 
 if __name__ == '__main__':